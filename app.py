@@ -3,22 +3,31 @@
 # ============================================================
 
 import os
+import hashlib
 import logging
+import queue
 import threading
 import time
-import json as _json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import paho.mqtt.client as mqtt
 import ssl
 import mercadopago
-import json
-from flask import Flask, jsonify, request, make_response, redirect, abort
+from mercadopago.http.http_client import HttpClient as MPHttpClient
+import orjson
+from flask import Flask, request, make_response, redirect, abort
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import raiseload
 
 # =========================
 # Configuración básica
@@ -41,25 +50,89 @@ MQTT_HOST = os.getenv("MQTT_HOST", "").strip()
 MQTT_PORT = int(os.getenv("MQTT_PORT", 8883))
 MQTT_USER = os.getenv("MQTT_USER", "").strip()
 MQTT_PASS = os.getenv("MQTT_PASS", "").strip()
+# Payload compacto "payment_id|slot_id|tiempo_segundos" (requiere firmware que lo soporte)
+MQTT_COMPACT_PAYLOAD = os.getenv("MQTT_COMPACT_PAYLOAD", "").strip().lower() in ("1", "true", "yes")
 
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "").strip()
 
+# raiseload("*") en los listados: un lazy-load accidental falla en vez de
+# disparar un SELECT por fila (activar en desarrollo / tests)
+RAISELOAD = os.getenv("RAISELOAD", "").strip().lower() in ("1", "true", "yes")
+
+# Tareas periódicas (watchdog offline). Es una variable de entorno, así que
+# vale igual para todos los workers de gunicorn de una réplica: con "1" cada
+# worker corre su propio watchdog (el UPDATE es idempotente). Con varias
+# réplicas/servicios, dejarlo en "1" sólo en una y "0" en el resto.
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "1").strip().lower() in ("1", "true", "yes")
+WATCHDOG_INTERVAL_S = float(os.getenv("WATCHDOG_INTERVAL_S", 5))
+
 # =========================
 # App + DB
 # =========================
 
+# Opciones de orjson para las respuestas HTTP: las comparten el provider de
+# Flask y orjson_response, así jsonify y los helpers aceptan lo mismo.
+_JSON_RESPONSE_OPTS = orjson.OPT_NON_STR_KEYS
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    jsonify / request.get_json con orjson. Los tipos que orjson no conoce
+    (Decimal, etc.) pasan por el `default` de Flask.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = _JSON_RESPONSE_OPTS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL or "sqlite:///local.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# /static/* (script.js, style.css): cacheable por el navegador/CDN 1h
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 3600
+
+# Pool por worker dimensionado para los hilos que usan la DB a la vez
+# (4 de gunicorn + 4 del webhook + 4 de MQTT + watchdog). Detrás de
+# PgBouncer en modo transaction (DATABASE_URL → pgbouncer:6432) conviene
+# DB_MAX_OVERFLOW=0; psycopg2 no usa prepared statements del lado del
+# servidor, así que es compatible. LIFO: se reusan las conexiones recién
+# devueltas y las ociosas expiran por pool_recycle en vez de rotar todas.
+if DATABASE_URL:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        "pool_use_lifo": True,
+        "pool_pre_ping": True,
+        "pool_recycle": 300,
+        # psycopg2: los executemany sin RETURNING van por execute_batch y los
+        # INSERT múltiples por "insertmanyvalues" (un VALUES (...),(...) por página)
+        "executemany_mode": "values_plus_batch",
+        "insertmanyvalues_page_size": 1000,
+        "executemany_batch_page_size": 500,
+        # Columnas JSONB (Pago.raw = payment completo de MP) con orjson
+        "json_serializer": lambda o: orjson.dumps(o).decode(),
+        "json_deserializer": orjson.loads,
+    }
 
 CORS(
     app,
     resources={r"/api/*": {"origins": "*"}},
     allow_headers=["Content-Type", "x-admin-secret"],
     expose_headers=["Content-Type"],
+    # El navegador cachea el preflight 24h: un OPTIONS menos por request del panel
+    max_age=86400,
 )
 
-db = SQLAlchemy(app)
+# expire_on_commit=False: los handlers devuelven justo después del commit,
+# no hace falta expirar (y recargar) todos los objetos de la sesión.
+# autoflush=False: los handlers hacen flush/commit explícito; las lecturas
+# no disparan un flush previo.
+db = SQLAlchemy(app, session_options={"expire_on_commit": False, "autoflush": False})
 logging.basicConfig(level=logging.INFO)
 app.logger.setLevel(logging.INFO)
 
@@ -93,12 +166,7 @@ class Cliente(db.Model):
     created_at = db.Column(db.DateTime, server_default=db.func.now())
 
     def serialize(self):
-      return {
-        "id": self.id,
-        "nombre": self.nombre,
-        "descripcion": self.descripcion,
-        "created_at": self.created_at.isoformat() if self.created_at else None
-    }
+        return serialize_cliente(self)
 
 # ---------- TOKENS MP por cliente ----------
 class MpTokenPorCliente(db.Model):
@@ -127,6 +195,13 @@ class Dispenser(db.Model):
 
     # NUEVO → A quién pertenece este dispenser
     cliente_id = db.Column(db.Integer, db.ForeignKey("cliente.id", ondelete="SET NULL"), nullable=True, index=True)
+    # lazy="raise": cualquier acceso sin carga explícita (join/selectinload) falla
+    cliente = db.relationship("Cliente", lazy="raise")
+    # Nunca lazy="dynamic" (un query por acceso). La colección sólo se usa
+    # en JOINs explícitos; los productos se cargan con select normal.
+    productos = db.relationship(
+        "Producto", back_populates="dispenser", lazy="select", passive_deletes=True
+    )
 
     # estado online/offline por MQTT
     online = db.Column(db.Boolean, nullable=False, server_default=db.text("false"))
@@ -139,6 +214,10 @@ class Producto(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     dispenser_id = db.Column(db.Integer, db.ForeignKey("dispenser.id", ondelete="SET NULL"), nullable=True, index=True)
+    # Carga perezosa: con "joined" cada SELECT de producto (listado,
+    # get_or_404 del PUT) arrastraba un LEFT OUTER JOIN a dispenser que nadie
+    # lee. Quien necesita el dispenser hace el join explícito.
+    dispenser = db.relationship("Dispenser", back_populates="productos", lazy="select")
 
     nombre = db.Column(db.String(100), nullable=False)
     precio = db.Column(db.Float, nullable=False)
@@ -157,6 +236,14 @@ class Producto(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint("dispenser_id", "slot_id", name="uq_disp_slot"),
+        # index-only scan para leer tiempo_ms por (dispenser, slot).
+        # En una base existente aplicar a mano
+        #   CREATE INDEX IF NOT EXISTS ix_prod_disp_slot_covering
+        #     ON producto (dispenser_id, slot_id) INCLUDE (tiempo_ms);
+        db.Index(
+            "ix_prod_disp_slot_covering", "dispenser_id", "slot_id",
+            postgresql_include=["tiempo_ms"],
+        ),
     )
 
 class Pago(db.Model):
@@ -175,27 +262,88 @@ class Pago(db.Model):
     device_id = db.Column(db.String(80), nullable=True, default="")
     raw = db.Column(JSONB, nullable=True)
     created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), nullable=False)
+
+    __table_args__ = (
+        # contable: pagos aprobados de un set de dispensers en un rango de
+        # fechas. Parcial: sólo indexa los approved, que son los que se leen.
+        # No hay migraciones: en una base existente aplicar a mano
+        #   DROP INDEX IF EXISTS ix_pago_disp_created;
+        #   CREATE INDEX IF NOT EXISTS ix_pago_aprobado_disp_created
+        #     ON pago (dispenser_id, created_at) WHERE estado = 'approved';
+        db.Index(
+            "ix_pago_aprobado_disp_created", "dispenser_id", "created_at",
+            postgresql_where=db.text("estado = 'approved'"),
+        ),
+    )
+
 # -----------------------
 # Helpers básicos
 # -----------------------
 
+# JSON rápido (orjson) para mensajes MQTT y payloads de MP
+_loads = orjson.loads
+_dumps = orjson.dumps
+
+def orjson_response(data, status=200):
+    """
+    Respuesta JSON serializada directo con orjson (sin pasar por jsonify).
+    Tipos que orjson no conoce (Decimal, etc.) pasan por el default de Flask.
+    """
+    return app.response_class(
+        _dumps(data, default=app.json.default, option=_JSON_RESPONSE_OPTS),
+        status=status, mimetype="application/json",
+    )
+
 def ok_json(data, status=200):
-    return jsonify(data), status
+    return orjson_response(data, status)
 
 def json_error(msg, status=400, extra=None):
     payload = {"error": msg}
     if extra is not None:
         payload["detail"] = extra
-    return jsonify(payload), status
+    return orjson_response(payload, status)
 
 def _to_int(x, default=0):
-    try:
+    # Casos comunes sin pasar por try/except (metadata de MP, query args)
+    if isinstance(x, int):
         return int(x)
+    try:
+        # int() de un string de más de 4300 dígitos lanza ValueError
+        # (límite de CPython): debe caer en el default como el resto.
+        if isinstance(x, str) and (x[1:] if x[:1] == "-" else x).isdecimal():
+            return int(x)
+        return int(float(x))
     except Exception:
-        try:
-            return int(float(x))
-        except Exception:
-            return default
+        return default
+
+# Columnas que usan los serializers: los listados las piden con un
+# SELECT de Core (filas, no objetos ORM) y las pasan al mismo serializer.
+_CLIENTE_COLS = (Cliente.id, Cliente.nombre, Cliente.descripcion, Cliente.created_at)
+
+_DISPENSER_COLS = (
+    Dispenser.id, Dispenser.device_id, Dispenser.nombre, Dispenser.activo,
+    Dispenser.online, Dispenser.cliente_id, Dispenser.last_seen, Dispenser.created_at,
+)
+
+_PRODUCTO_COLS = (
+    Producto.id, Producto.dispenser_id, Producto.nombre, Producto.precio,
+    Producto.slot_id, Producto.habilitado, Producto.tiempo_ms,
+    Producto.created_at, Producto.updated_at,
+)
+
+_PAGO_COLS = (
+    Pago.id, Pago.mp_payment_id, Pago.estado, Pago.producto, Pago.product_id,
+    Pago.dispenser_id, Pago.device_id, Pago.slot_id, Pago.litros, Pago.monto,
+    Pago.dispensado, Pago.procesado, Pago.created_at,
+)
+
+def serialize_cliente(c: Cliente) -> dict:
+    return {
+        "id": c.id,
+        "nombre": c.nombre,
+        "descripcion": c.descripcion,
+        "created_at": c.created_at.isoformat() if c.created_at else None,
+    }
 
 def serialize_dispenser(d: Dispenser) -> dict:
     return {
@@ -209,6 +357,14 @@ def serialize_dispenser(d: Dispenser) -> dict:
         "created_at": d.created_at.isoformat() if d.created_at else None,
     }
 
+# Los datetime quedan para orjson (ISO 8601 en C, mismo formato que
+# isoformat()). Los casts se mantienen: un Producto recién creado con los
+# defaults del ORM trae precio=0 (int) y la API siempre devolvió 0.0.
+_PRODUCTO_KEYS = (
+    "id", "dispenser_id", "nombre", "precio", "slot",
+    "habilitado", "tiempo_ms", "created_at", "updated_at",
+)
+
 def serialize_producto(p: Producto) -> dict:
     return {
         "id": p.id,
@@ -218,50 +374,76 @@ def serialize_producto(p: Producto) -> dict:
         "slot": int(p.slot_id),
         "habilitado": bool(p.habilitado),
         "tiempo_ms": int(p.tiempo_ms),
+        "created_at": p.created_at,
+        "updated_at": p.updated_at,
+    }
+
+# ?fields= en el listado: clave de salida → columna
+_PRODUCTO_FIELD_COLS = dict(zip(_PRODUCTO_KEYS, _PRODUCTO_COLS))
+
+def list_load_options() -> list:
+    """
+    Opciones de carga para queries ORM de listados. Con RAISELOAD (o en
+    debug) cualquier relación no cargada explícitamente levanta error.
+    """
+    if RAISELOAD or app.debug:
+        return [raiseload("*")]
+    return []
+
+def serialize_pago(p: Pago) -> dict:
+    return {
+        "id": p.id,
+        "mp_payment_id": p.mp_payment_id,
+        "estado": p.estado,
+        "producto": p.producto,
+        "product_id": p.product_id,
+        "dispenser_id": p.dispenser_id,
+        "device_id": p.device_id,
+        "slot_id": p.slot_id,
+        "litros": p.litros,
+        "monto": p.monto,
+        "dispensado": bool(p.dispensado),
+        "procesado": bool(p.procesado),
         "created_at": p.created_at.isoformat() if p.created_at else None,
-        "updated_at": p.updated_at.isoformat() if p.updated_at else None,
     }
 
 def kv_set(key, value):
-    row = KV.query.get(key)
-    if row:
-        row.value = value
-    else:
-        row = KV(key=key, value=value)
-        db.session.add(row)
+    db.session.merge(KV(key=key, value=value))
     db.session.commit()
 
 def kv_get(key, default=""):
-    row = KV.query.get(key)
+    row = db.session.get(KV, key)
     return row.value if row else default
 
 # -----------------------
 # Auth simple Admin / rutas públicas
 # -----------------------
 
-PUBLIC_PATHS = {
+PUBLIC_PATHS = frozenset({
     "/", "/gracias",
     "/api/config",
     "/api/pagos/preferencia",
     "/api/mp/webhook", "/webhook", "/mp/webhook",
     "/api/mp/oauth/init",
     "/api/mp/oauth/callback",
-}
+})
+
+# str.startswith acepta una tupla → un solo chequeo para todos los prefijos
+PUBLIC_PREFIXES = ("/qr/",)
 
 @app.before_request
 def _auth_guard():
     if request.method == "OPTIONS":
         return "", 200
 
-    p = request.path
-
-    if p in PUBLIC_PATHS or p.startswith("/qr/"):
+    if request.endpoint in _PUBLIC_ENDPOINTS:
         return None
 
     if not ADMIN_SECRET:
         return None
 
-    if request.headers.get("x-admin-secret") != ADMIN_SECRET:
+    secret = request.headers.get("x-admin-secret")
+    if secret != ADMIN_SECRET:
         return json_error("unauthorized", 401)
 
     return None
@@ -270,9 +452,21 @@ def _auth_guard():
 # MP: modo global (fallback)
 # -----------------------
 
+# mp_mode se cambia a mano desde el admin; lo cacheamos para no
+# consultar KV en cada health-check / webhook.
+_MP_MODE_TTL = 30.0
+_MP_MODE_CACHE = {"v": None, "t": 0.0}
+
 def get_mp_mode() -> str:
-    row = KV.query.get("mp_mode")
-    return (row.value if row else "test").lower()
+    now = time.monotonic()
+    if _MP_MODE_CACHE["v"] and now - _MP_MODE_CACHE["t"] < _MP_MODE_TTL:
+        return _MP_MODE_CACHE["v"]
+
+    row = db.session.get(KV, "mp_mode")
+    mode = (row.value if row else "test").lower()
+    _MP_MODE_CACHE["v"] = mode
+    _MP_MODE_CACHE["t"] = now
+    return mode
 
 def get_global_mp_token_and_base():
     """
@@ -284,22 +478,63 @@ def get_global_mp_token_and_base():
         return MP_ACCESS_TOKEN_LIVE, "https://api.mercadopago.com"
     return MP_ACCESS_TOKEN_TEST, "https://api.mercadopago.com"
 
+# -----------------------
+# MP: sesión HTTP compartida (keep-alive)
+# -----------------------
+
+# Reusar la conexión TLS a api.mercadopago.com en vez de abrir una por
+# llamada. Retry sólo reintenta métodos idempotentes (no POST).
+_mp_session = requests.Session()
+_mp_session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+
+# (connect, read): si MP no acepta la conexión se corta en 3s en vez de
+# retener el hilo del worker hasta 20s
+MP_TIMEOUT = (float(os.getenv("MP_CONNECT_TIMEOUT", 3)), float(os.getenv("MP_READ_TIMEOUT", 15)))
+
 # -----------------------
 # MP: Obtener token por dispenser (MULTI-CLIENTE)
 # -----------------------
 
+# Los tokens sólo cambian con OAuth callback/unlink, asignación de cliente
+# o cambio de modo: se cachean por dispenser y se invalidan en esos puntos.
+_TOKEN_CACHE_TTL = 300.0
+_TOKEN_CACHE_MAX = 512
+_TOKEN_CACHE: dict[int, tuple[float, str]] = {}
+
+def invalidar_token_cache():
+    _TOKEN_CACHE.clear()
+
 def get_token_por_dispenser(dispenser_id: int) -> str:
     """
     Devuelve el access_token de MP correspondiente al cliente dueño del dispenser.
     Si el dispenser no tiene cliente o el cliente no tiene OAuth, usa token global.
     """
-    disp = Dispenser.query.get(dispenser_id)
+    now = time.monotonic()
+    hit = _TOKEN_CACHE.get(dispenser_id)
+    if hit and now - hit[0] < _TOKEN_CACHE_TTL:
+        return hit[1]
+
+    token = _cargar_token_por_dispenser(dispenser_id)
+
+    if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+        _TOKEN_CACHE.clear()
+    _TOKEN_CACHE[dispenser_id] = (now, token)
+    return token
+
+def _cargar_token_por_dispenser(dispenser_id: int) -> str:
+    disp = db.session.get(Dispenser, dispenser_id)
     if not disp:
         raise Exception("Dispenser no encontrado")
 
     # Si tiene cliente asignado, buscamos token OAuth de ese cliente
     if disp.cliente_id:
-        tok = MpTokenPorCliente.query.filter_by(cliente_id=disp.cliente_id).first()
+        tok = db.session.scalars(
+            db.select(MpTokenPorCliente).where(MpTokenPorCliente.cliente_id == disp.cliente_id)
+        ).first()
         if tok and tok.access_token:
             # Si quisieras, acá podrías refrescar el token si expired.
             return tok.access_token
@@ -315,7 +550,6 @@ def get_token_por_dispenser(dispenser_id: int) -> str:
 # =========================
 
 _mqtt_client: Optional[mqtt.Client] = None
-_mqtt_lock = threading.Lock()
 
 def topic_cmd(device_id: str) -> str:
     return f"dispen/{device_id}/cmd/dispense"
@@ -342,16 +576,20 @@ def _handle_status_message(topic: str, payload_raw: bytes):
     # Caso simple: texto plano
     if raw == "online":
         if device_id:
-            disp = Dispenser.query.filter_by(device_id=device_id).first()
-            if disp:
-                disp.online = True
-                db.session.commit()
+            res = db.session.execute(
+                db.update(Dispenser)
+                .where(Dispenser.device_id == device_id)
+                .values(online=True),
+                execution_options={"synchronize_session": False},
+            )
+            db.session.commit()
+            if res.rowcount:
                 app.logger.info(f"[MQTT] {device_id} marcado ONLINE (raw)")
         return
 
     # Caso JSON
     try:
-        data = json.loads(raw) if raw else {}
+        data = _loads(raw) if raw else {}
     except Exception:
         data = {}
 
@@ -361,19 +599,25 @@ def _handle_status_message(topic: str, payload_raw: bytes):
     if not dev or not status:
         return
 
-    disp = Dispenser.query.filter_by(device_id=dev).first()
-    if not disp:
-        return
-
     if status in ("online", "reconnected", "wifi_reconnected"):
-        disp.online = True
-        disp.last_seen = datetime.utcnow()
+        # now() lo pone Postgres: no se arma un datetime por mensaje
+        valores = {"online": True, "last_seen": db.func.now()}
     elif status == "offline":
-        disp.online = False
+        valores = {"online": False}
+    else:
+        return
 
+    # Un solo UPDATE en vez de SELECT + UPDATE por mensaje
     try:
+        res = db.session.execute(
+            db.update(Dispenser)
+            .where(Dispenser.device_id == dev)
+            .values(**valores),
+            execution_options={"synchronize_session": False},
+        )
         db.session.commit()
-        app.logger.info(f"[ONLINE] {dev} → {disp.online}")
+        if res.rowcount:
+            app.logger.info(f"[ONLINE] {dev} → {valores['online']}")
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"[ONLINE] Error guardando estado: {e}")
@@ -390,7 +634,7 @@ def _handle_ack_message(topic: str, payload_raw: bytes):
         raw = ""
 
     try:
-        data = json.loads(raw) if raw else {}
+        data = _loads(raw) if raw else {}
     except Exception:
         app.logger.error(f"[MQTT] ACK JSON inválido: {raw!r}")
         return
@@ -404,33 +648,78 @@ def _handle_ack_message(topic: str, payload_raw: bytes):
 
     app.logger.info(f"[MQTT] ACK recibido para pago_id={pago_id}, slot={slot_id}")
 
-    pago = Pago.query.filter_by(mp_payment_id=str(pago_id)).first()
-    if not pago:
-        app.logger.error(f"[MQTT] Pago {pago_id} no encontrado en DB")
-        return
-
-    pago.dispensado = True
-
     try:
+        res = db.session.execute(
+            db.update(Pago)
+            .where(Pago.mp_payment_id == str(pago_id))
+            .values(dispensado=True),
+            execution_options={"synchronize_session": False},
+        )
         db.session.commit()
+        if not res.rowcount:
+            app.logger.error(f"[MQTT] Pago {pago_id} no encontrado en DB")
+            return
         app.logger.info(f"[MQTT] Pago {pago_id} marcado como DISPENSADO ✔")
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"[MQTT] Error guardando DISPENSADO: {e}")
 
+def _mqtt_dispatch(topic: str, payload: bytes):
+    if topic.startswith("dispen/") and topic.endswith("/status"):
+        _handle_status_message(topic, payload)
+        return
+
+    if topic.startswith("dispen/") and topic.endswith("/state/dispense"):
+        _handle_ack_message(topic, payload)
+        return
+
 def _mqtt_on_message(client, userdata, msg):
     app.logger.info(f"[MQTT RX] {msg.topic}: {msg.payload!r}")
 
-    if msg.topic.startswith("dispen/") and msg.topic.endswith("/status"):
-        _handle_status_message(msg.topic, msg.payload)
+    # El hilo de red de paho sólo encola; la DB la tocan los workers.
+    # Mismo topic → mismo worker, así se respeta el orden por dispenser.
+    if not _mqtt_queues:
+        with app.app_context():
+            _mqtt_dispatch(msg.topic, msg.payload)
         return
 
-    if msg.topic.startswith("dispen/") and msg.topic.endswith("/state/dispense"):
-        _handle_ack_message(msg.topic, msg.payload)
+    q = _mqtt_queues[hash(msg.topic) % len(_mqtt_queues)]
+    try:
+        q.put_nowait((msg.topic, msg.payload))
+    except queue.Full:
+        app.logger.error(f"[MQTT] Cola llena, se descarta mensaje de {msg.topic}")
+
+# =========================
+# MQTT WORKERS
+# =========================
+
+MQTT_WORKERS = 4
+MQTT_QUEUE_MAX = 2500  # por worker
+
+_mqtt_queues: list[queue.Queue] = []
+
+def _mqtt_worker(q: queue.Queue):
+    while True:
+        topic, payload = q.get()
+        try:
+            with app.app_context():
+                _mqtt_dispatch(topic, payload)
+        except Exception:
+            app.logger.exception(f"[MQTT] Error procesando mensaje de {topic}")
+
+def _start_mqtt_workers():
+    if _mqtt_queues:
         return
 
+    for i in range(MQTT_WORKERS):
+        q = queue.Queue(maxsize=MQTT_QUEUE_MAX)
+        threading.Thread(
+            target=_mqtt_worker, args=(q,), name=f"mqtt-worker-{i}", daemon=True
+        ).start()
+        _mqtt_queues.append(q)
+
 # =========================
-# MQTT THREAD
+# MQTT CLIENTE
 # =========================
 
 def start_mqtt_background():
@@ -438,39 +727,102 @@ def start_mqtt_background():
         app.logger.warning("[MQTT] MQTT_HOST no configurado; no se inicia MQTT")
         return
 
-    app.logger.info("[MQTT] Iniciando hilo MQTT...")
-    th = threading.Thread(target=_run_mqtt, name="mqtt-thread", daemon=True)
-    th.start()
+    # Un solo cliente por proceso, compartido por todos los handlers
+    if _mqtt_client is not None:
+        return
 
-def _run_mqtt():
-    global _mqtt_client
+    _start_mqtt_workers()
 
-    with app.app_context():
-        _mqtt_client = mqtt.Client(
-            mqtt.CallbackAPIVersion.VERSION2,
-            client_id="dispen-agua-backend"
-        )
+    app.logger.info("[MQTT] Iniciando cliente MQTT...")
+    _init_mqtt_client()
 
-        if MQTT_USER or MQTT_PASS:
-            _mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
+def _init_mqtt_client():
+    """
+    Usa el loop de red propio de paho (loop_start): socket no bloqueante,
+    conexión asíncrona y reconexión automática, incluso si el broker no
+    está disponible al arrancar.
+    """
+    global _mqtt_client
 
-        if MQTT_PORT == 8883:
-            try:
-                _mqtt_client.tls_set()
-            except Exception as e:
-                app.logger.error(f"[MQTT] TLS error: {e}")
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id="dispen-agua-backend"
+    )
 
-        _mqtt_client.on_connect = _mqtt_on_connect
-        _mqtt_client.on_message = _mqtt_on_message
+    if MQTT_USER or MQTT_PASS:
+        client.username_pw_set(MQTT_USER, MQTT_PASS)
 
+    if MQTT_PORT == 8883:
         try:
-            app.logger.info(f"[MQTT] Conectando a {MQTT_HOST}:{MQTT_PORT} ...")
-            _mqtt_client.connect(MQTT_HOST, MQTT_PORT, keepalive=30)
+            client.tls_set()
         except Exception as e:
-            app.logger.error(f"[MQTT] ERROR al conectar: {e}")
-            return
+            app.logger.error(f"[MQTT] TLS error: {e}")
+
+    client.on_connect = _mqtt_on_connect
+    client.on_message = _mqtt_on_message
+
+    client.max_inflight_messages_set(100)
+    client.max_queued_messages_set(1000)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+    try:
+        app.logger.info(f"[MQTT] Conectando a {MQTT_HOST}:{MQTT_PORT} ...")
+        client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=30)
+    except Exception as e:
+        app.logger.error(f"[MQTT] ERROR al conectar: {e}")
+        return
+
+    _mqtt_client = client
+    client.loop_start()
+
+# =========================
+# CACHE tiempo_ms por (dispenser_id, slot_id)
+# =========================
+
+# tiempo_ms sólo cambia desde los endpoints de productos, así que lo
+# mantenemos en memoria y evitamos una consulta por cada dispensado.
+# El write-through sólo llega al worker que atendió el PUT: cada entrada
+# guarda su instante de carga y se relee de DB pasado el TTL, así los demás
+# workers no dispensan con un tiempo_ms viejo más que unos segundos.
+_TIEMPO_MS_TTL = 30.0
+TIEMPO_MS_CACHE: dict[tuple[int, int], tuple[float, int]] = {}  # (t, tiempo_ms)
+_tiempo_ms_lock = threading.RLock()
+
+def set_tiempo_ms_cache(p: Producto, slot_anterior: Optional[int] = None):
+    """
+    Write-through del cache después de crear/actualizar un producto.
+    Si cambió el slot, se descarta la clave vieja.
+    """
+    if p.dispenser_id is None:
+        return
 
-        _mqtt_client.loop_forever()
+    disp_id = int(p.dispenser_id)
+    with _tiempo_ms_lock:
+        if slot_anterior is not None and slot_anterior != p.slot_id:
+            TIEMPO_MS_CACHE.pop((disp_id, int(slot_anterior)), None)
+        TIEMPO_MS_CACHE[(disp_id, int(p.slot_id))] = (time.monotonic(), int(p.tiempo_ms or 1000))
+
+def get_tiempo_ms(dispenser_id: int, slot_id: int) -> int:
+    with _tiempo_ms_lock:
+        entry = TIEMPO_MS_CACHE.get((dispenser_id, slot_id))
+    if entry is not None and time.monotonic() - entry[0] < _TIEMPO_MS_TTL:
+        return entry[1]
+
+    # Miss o vencido (producto creado/editado desde otro worker) → releer de
+    # DB. Sólo la columna (index-only scan sobre ix_prod_disp_slot_covering).
+    row = db.session.execute(
+        db.select(Producto.dispenser_id, Producto.slot_id, Producto.tiempo_ms).where(
+            Producto.dispenser_id == dispenser_id,
+            Producto.slot_id == slot_id,
+        )
+    ).first()
+    if not row:
+        with _tiempo_ms_lock:
+            TIEMPO_MS_CACHE.pop((dispenser_id, slot_id), None)
+        return 1000
+
+    set_tiempo_ms_cache(row)
+    return int(row.tiempo_ms or 1000)
 
 def send_dispense_cmd(device_id: str, payment_id: str, slot_id: int, dispenser_id: int, litros: int = 1) -> bool:
     """
@@ -478,44 +830,66 @@ def send_dispense_cmd(device_id: str, payment_id: str, slot_id: int, dispenser_i
       - payment_id
       - slot_id
       - tiempo_segundos (tomado desde producto.tiempo_ms)
+    En JSON por defecto, o "payment_id|slot_id|tiempo_segundos" si
+    MQTT_COMPACT_PAYLOAD está activo.
     """
     if not MQTT_HOST:
         app.logger.error("[MQTT] MQTT_HOST no configurado")
         return False
 
-    prod = Producto.query.filter_by(
-        dispenser_id=dispenser_id,
-        slot_id=slot_id
-    ).first()
-
-    if prod:
-        tiempo_ms = int(prod.tiempo_ms or 1000)
-    else:
-        tiempo_ms = 1000
+    tiempo_ms = get_tiempo_ms(int(dispenser_id), int(slot_id))
 
     tiempo_segundos = max(1, int(tiempo_ms / 1000))
 
-    topic = f"dispen/{device_id}/cmd/dispense"
-    payload = json.dumps({
-        "payment_id": str(payment_id),
-        "slot_id": int(slot_id),
-        "tiempo_segundos": tiempo_segundos
-    })
+    topic = topic_cmd(device_id)
+    if MQTT_COMPACT_PAYLOAD:
+        payload = f"{payment_id}|{int(slot_id)}|{tiempo_segundos}".encode()
+    else:
+        payload = _dumps({
+            "payment_id": str(payment_id),
+            "slot_id": int(slot_id),
+            "tiempo_segundos": tiempo_segundos
+        })
 
     app.logger.info(
-        f"[MQTT] → {topic} | tiempo_ms={tiempo_ms}, tiempo_segundos={tiempo_segundos}, payload={payload}"
+        f"[MQTT] → {topic} | tiempo_ms={tiempo_ms}, tiempo_segundos={tiempo_segundos}, payload={payload.decode()}"
     )
 
-    for intento in range(10):
-        with _mqtt_lock:
-            if _mqtt_client:
-                info = _mqtt_client.publish(topic, payload, qos=1, retain=False)
-                if info.rc == mqtt.MQTT_ERR_SUCCESS:
-                    return True
-        time.sleep(0.3)
+    client = _mqtt_client
+    if client is None:
+        app.logger.error("[MQTT] ERROR: cliente MQTT no inicializado")
+        return False
 
-    app.logger.error("[MQTT] ERROR: no se pudo publicar el comando después de 10 intentos")
-    return False
+    # Sin conexión no se publica: paho encolaría el QoS 1 y lo entregaría al
+    # reconectar, y el llamador no podría saber si el comando va a salir.
+    # False significa siempre "no quedó nada encolado".
+    if not client.is_connected():
+        app.logger.error(f"[MQTT] ERROR: broker desconectado, no se publica en {topic}")
+        return False
+
+    # payload ya es bytes (orjson / compacto): paho lo publica tal cual.
+    # paho es thread-safe para publish y encola internamente (QoS 1),
+    # no hace falta lock ni reintentos manuales.
+    info = client.publish(topic, payload, qos=1, retain=False)
+    if info.rc == mqtt.MQTT_ERR_NO_CONN:
+        # Se cortó entre el chequeo y el publish: el mensaje quedó en la
+        # cola de paho y sale al reconectar, así que cuenta como enviado.
+        app.logger.warning(f"[MQTT] Conexión caída al publicar en {topic}; queda en cola de paho")
+        return True
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        app.logger.error(f"[MQTT] ERROR publicando comando: {mqtt.error_string(info.rc)}")
+        return False
+
+    try:
+        info.wait_for_publish(timeout=2.0)
+    except (ValueError, RuntimeError) as e:
+        app.logger.error(f"[MQTT] ERROR publicando comando: {e}")
+        return False
+
+    if not info.is_published():
+        app.logger.warning(f"[MQTT] Sin PUBACK en 2s para {topic}; queda en cola de paho")
+
+    return True
 
 # =========================
 # PROCESAR PAGO
@@ -534,13 +908,13 @@ def _procesar_pago_desde_info(payment_id: str, info: dict):
             pref_id = info.get("order", {}).get("id") or info.get("preference_id")
             if pref_id:
                 token_global, _ = get_global_mp_token_and_base()
-                r2 = requests.get(
+                r2 = _mp_session.get(
                     f"https://api.mercadopago.com/checkout/preferences/{pref_id}",
                     headers={"Authorization": f"Bearer {token_global}"},
-                    timeout=10
+                    timeout=MP_TIMEOUT
                 )
                 r2.raise_for_status()
-                pref_info = r2.json() or {}
+                pref_info = _loads(r2.content) or {}
                 meta2 = pref_info.get("metadata") or {}
                 if meta2:
                     metadata = meta2
@@ -560,61 +934,108 @@ def _procesar_pago_desde_info(payment_id: str, info: dict):
         app.logger.error(f"[WEBHOOK] Falta device_id o slot_id en payment_id={payment_id}")
         return "ok", 200
 
-    pago = Pago.query.filter_by(mp_payment_id=str(payment_id)).first()
-    if pago and pago.procesado and status == "approved":
+    # Upsert en un solo round-trip (mp_payment_id es UNIQUE). Si el pago ya
+    # fue procesado y vuelve a llegar "approved", el WHERE evita tocarlo y
+    # RETURNING no devuelve fila → duplicado. Esto no alcanza con entregas
+    # concurrentes: el reclamo atómico de abajo es el que evita dispensar dos veces.
+    ins = pg_insert(Pago).values(
+        mp_payment_id=str(payment_id),
+        estado=status,
+        producto=producto_nom,
+        procesado=False,
+        slot_id=slot_id,
+        litros=litros_md,
+        product_id=product_id,
+        dispenser_id=dispenser_id,
+        device_id=device_id,
+        monto=monto_val,
+        raw=info
+    )
+    exc = ins.excluded
+    stmt = ins.on_conflict_do_update(
+        index_elements=[Pago.mp_payment_id],
+        set_={
+            "estado": exc.estado,
+            "producto": db.func.coalesce(db.func.nullif(exc.producto, ""), Pago.producto),
+            "slot_id": db.func.coalesce(db.func.nullif(exc.slot_id, 0), Pago.slot_id),
+            "litros": db.func.coalesce(db.func.nullif(exc.litros, 0), Pago.litros),
+            "monto": db.func.coalesce(db.func.nullif(exc.monto, 0), Pago.monto),
+            "raw": exc.raw,
+        },
+        where=db.not_(db.and_(Pago.procesado.is_(True), exc.estado == "approved")),
+    ).returning(Pago.id, Pago.procesado)
+
+    row = db.session.execute(stmt).first()
+    db.session.commit()
+
+    if row is None:
         app.logger.info(f"[WEBHOOK] Pago {payment_id} ya procesado, ignorando duplicado")
         return
 
-    if not pago:
-        pago = Pago(
-            mp_payment_id=str(payment_id),
-            estado=status,
-            producto=producto_nom,
-            procesado=False,
-            slot_id=slot_id,
-            litros=litros_md,
-            product_id=product_id,
-            dispenser_id=dispenser_id,
-            device_id=device_id,
-            monto=monto_val,
-            raw=info
-        )
-        db.session.add(pago)
-    else:
-        pago.estado = status
-        pago.producto = producto_nom or pago.producto
-        pago.slot_id = slot_id or pago.slot_id
-        pago.litros = litros_md or pago.litros
-        pago.monto = monto_val or pago.monto
-        pago.raw = info
-
-    db.session.commit()
+    pago_id, procesado = row
+
+    if status == "approved" and not procesado:
+        # Reclamar el pago antes de publicar: entregas concurrentes del mismo
+        # pago (varios workers) pasan el upsert a la vez, pero sólo una
+        # consigue pasar procesado de false a true.
+        reclamado = db.session.execute(
+            db.update(Pago)
+            .where(Pago.id == pago_id, Pago.procesado.is_(False), Pago.estado == "approved")
+            .values(procesado=True)
+            .returning(Pago.id)
+        ).first()
+        db.session.commit()
+        if reclamado is None:
+            app.logger.info(f"[WEBHOOK] Pago {payment_id} ya reclamado por otra entrega")
+            return
 
-    if status == "approved" and not pago.procesado:
-        ok = send_dispense_cmd(device_id, payment_id, slot_id, dispenser_id, litros_md)
+        # send_dispense_cmd devuelve False sólo si no quedó nada encolado en
+        # paho; una excepción (p. ej. DB en get_tiempo_ms) salta antes del
+        # publish. En ambos casos se libera el reclamo para que un reintento
+        # de MP pueda dispensar; si el mensaje quedó encolado se conserva.
+        try:
+            ok = send_dispense_cmd(device_id, payment_id, slot_id, dispenser_id, litros_md)
+        except Exception:
+            app.logger.exception(f"[MQTT] ERROR preparando comando para {device_id}")
+            db.session.rollback()
+            ok = False
         if ok:
-            pago.procesado = True
-            db.session.commit()
             app.logger.info(f"[WEBHOOK] Pago {payment_id} marcado como procesado")
         else:
+            db.session.execute(
+                db.update(Pago).where(Pago.id == pago_id).values(procesado=False)
+            )
+            db.session.commit()
             app.logger.error(f"[MQTT] ERROR al enviar comando a {device_id}")
 
 # =========================
 # RUTAS BÁSICAS
 # =========================
 
+# Las respuestas de health/config sólo dependen de mp_mode: se guardan ya
+# serializadas y se regeneran cuando cambia el modo.
+_HEALTH_CACHE = {"entry": (None, b"", b"")}  # (mp_mode, health, config)
+
+def _health_bodies(mode: str):
+    entry = _HEALTH_CACHE["entry"]
+    if entry[0] != mode:
+        entry = (
+            mode,
+            _dumps({"status": "ok", "mp_mode": mode}),
+            _dumps({"mp_mode": mode}),
+        )
+        _HEALTH_CACHE["entry"] = entry
+    return entry
+
 @app.get("/")
 def health():
-    return ok_json({
-        "status": "ok",
-        "mp_mode": get_mp_mode(),
-    })
+    _, body, _ = _health_bodies(get_mp_mode())
+    return app.response_class(body, mimetype="application/json")
 
 @app.get("/api/config")
 def api_config():
-    return ok_json({
-        "mp_mode": get_mp_mode(),
-    })
+    _, _, body = _health_bodies(get_mp_mode())
+    return app.response_class(body, mimetype="application/json")
 
 @app.post("/api/mp/mode")
 def api_set_mp_mode():
@@ -623,11 +1044,13 @@ def api_set_mp_mode():
     if mode not in ("test", "live"):
         return json_error("modo inválido (test|live)", 400)
 
-    kv = KV.query.get("mp_mode") or KV(key="mp_mode", value=mode)
-    kv.value = mode
-    db.session.merge(kv)
+    db.session.merge(KV(key="mp_mode", value=mode))
     db.session.commit()
 
+    _MP_MODE_CACHE["v"] = mode
+    _MP_MODE_CACHE["t"] = time.monotonic()
+    invalidar_token_cache()  # el fallback global depende del modo
+
     return ok_json({"ok": True, "mp_mode": mode})
 
 # =========================
@@ -648,35 +1071,67 @@ def crear_cliente():
     c = Cliente(nombre=nombre, descripcion=descripcion)
     db.session.add(c)
     db.session.commit()
+    _invalidar_clientes_cache()
 
     return ok_json({"ok": True, "cliente": c.serialize()})
 
+# El panel admin consulta /api/clientes seguido y la tabla casi no cambia:
+# guardamos el JSON ya serializado unos segundos y respondemos 304 si el
+# navegador ya tiene esa versión (ETag).
+_CLIENTES_CACHE_TTL = 5.0
+_CLIENTES_CACHE = {"entry": None}  # (t, body, etag)
+
+def _invalidar_clientes_cache():
+    _CLIENTES_CACHE["entry"] = None
+
 @app.get("/api/clientes")
 def listar_clientes():
-    return jsonify([c.serialize() for c in Cliente.query.order_by(Cliente.id.asc()).all()])
+    now = time.monotonic()
+    entry = _CLIENTES_CACHE["entry"]
+
+    if entry is None or now - entry[0] >= _CLIENTES_CACHE_TTL:
+        rows = db.session.execute(
+            db.select(*_CLIENTE_COLS).order_by(Cliente.id.asc())
+        ).all()
+        body = _dumps([serialize_cliente(r) for r in rows], option=_JSON_RESPONSE_OPTS)
+        etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        entry = (now, body, etag)
+        _CLIENTES_CACHE["entry"] = entry
+
+    _, body, etag = entry
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 @app.route("/api/clientes/<int:cid>", methods=["DELETE"])
 def delete_cliente(cid):
     require_admin()
 
-    cli = Cliente.query.get(cid)
-    if not cli:
-        return jsonify({"error": "Cliente no encontrado"}), 404
+    # Un solo DELETE … RETURNING: sólo borra si no tiene dispensers asignados
+    borrado = db.session.execute(
+        db.delete(Cliente)
+        .where(
+            Cliente.id == cid,
+            ~db.select(Dispenser.id).where(Dispenser.cliente_id == cid).exists(),
+        )
+        .returning(Cliente.id)
+    ).first()
+    db.session.commit()
 
-    # Verificar dispensers asignados
-    relacionados = Dispenser.query.filter_by(cliente_id=cid).count()
-    if relacionados > 0:
-        return jsonify({"error": "El cliente aún tiene dispensers asignados"}), 400
+    if borrado is None:
+        # Camino de error: distinguir inexistente de cliente con dispensers
+        if db.session.get(Cliente, cid) is None:
+            return json_error("Cliente no encontrado", 404)
+        return json_error("El cliente aún tiene dispensers asignados", 400)
 
-    db.session.delete(cli)
-    db.session.commit()
+    _invalidar_clientes_cache()
 
-    return jsonify({"msg": "Cliente eliminado correctamente"})
+    return ok_json({"msg": "Cliente eliminado correctamente"})
 
 @app.put("/api/cliente/<int:cid>")
 def actualizar_cliente(cid):
     require_admin()
-    c = Cliente.query.get(cid)
+    c = db.session.get(Cliente, cid)
     if not c:
         return json_error("Cliente no encontrado", 404)
 
@@ -689,6 +1144,7 @@ def actualizar_cliente(cid):
        c.descripcion = (data["descripcion"] or "").strip()
 
     db.session.commit()
+    _invalidar_clientes_cache()
 
     return ok_json({
         "ok": True,
@@ -704,8 +1160,16 @@ def actualizar_cliente(cid):
 
 @app.get("/api/dispensers")
 def api_dispensers_list():
-    ds = Dispenser.query.order_by(Dispenser.id.asc()).all()
-    return jsonify([serialize_dispenser(d) for d in ds])
+    # El nombre del cliente viene en el mismo SELECT (LEFT JOIN), sin 1+N
+    rows = db.session.execute(
+        db.select(*_DISPENSER_COLS, Cliente.nombre.label("cliente_nombre"))
+        .outerjoin(Dispenser.cliente)
+        .order_by(Dispenser.id.asc())
+    ).all()
+    return orjson_response([
+        {**serialize_dispenser(r), "cliente_nombre": r.cliente_nombre}
+        for r in rows
+    ])
 
 @app.post("/api/dispensers")
 def api_dispensers_create():
@@ -715,8 +1179,7 @@ def api_dispensers_create():
         cliente_id = data.get("cliente_id")
 
         if not name:
-            all_d = Dispenser.query.order_by(Dispenser.id.asc()).all()
-            next_num = len(all_d) + 1
+            next_num = db.session.scalar(db.select(db.func.count(Dispenser.id))) + 1
             name = f"dispen-{next_num:02d}"
 
         device_id = name
@@ -728,7 +1191,7 @@ def api_dispensers_create():
             cliente_id=cliente_id
         )
         db.session.add(d)
-        db.session.commit()
+        db.session.flush()  # asigna d.id sin cerrar la transacción
 
         p1 = Producto(
             dispenser_id=d.id,
@@ -746,10 +1209,13 @@ def api_dispensers_create():
             slot_id=2,
             habilitado=False,
         )
-        db.session.add(p1)
-        db.session.add(p2)
+        db.session.add_all([p1, p2])
         db.session.commit()
 
+        set_tiempo_ms_cache(p1)
+        set_tiempo_ms_cache(p2)
+        _invalidar_productos_cache()
+
         return ok_json({
             "ok": True,
             "dispenser": serialize_dispenser(d),
@@ -780,13 +1246,14 @@ def asignar_cliente(disp_id):
 
     # Si viene un ID, validarlo
     if cliente_id is not None:
-        cli = Cliente.query.get(cliente_id)
+        cli = db.session.get(Cliente, cliente_id)
         if not cli:
             return json_error("cliente_id inválido", 400)
 
-    disp = Dispenser.query.get_or_404(disp_id)
+    disp = db.get_or_404(Dispenser, disp_id)
     disp.cliente_id = cliente_id
     db.session.commit()
+    invalidar_token_cache()
 
     return ok_json({
         "ok": True,
@@ -798,23 +1265,86 @@ def asignar_cliente(disp_id):
 # PRODUCTOS
 # =========================
 
-@app.get("/api/productos")
-def api_productos_list():
-    disp_id = _to_int(request.args.get("dispenser_id") or 0)
+# Listado de productos ya serializado por (dispenser_id, fields), unos
+# segundos. Los writes de este worker lo invalidan; los de otros workers se
+# ven al vencer el TTL (y si el ETag no cambió no se vuelve a serializar).
+_PRODUCTOS_CACHE_TTL = 5.0
+_PRODUCTOS_CACHE_MAX = 256
+_PRODUCTOS_CACHE: dict[tuple, tuple[float, str, bytes]] = {}  # key → (t, etag, body)
+
+def _invalidar_productos_cache():
+    _PRODUCTOS_CACHE.clear()
 
-    q = Producto.query
+def _productos_etag(disp_id: int) -> str:
+    # ETag débil de (max(updated_at), count): todo alta/edición mueve
+    # updated_at y toda baja el count.
+    agg = db.select(db.func.max(Producto.updated_at), db.func.count(Producto.id))
+    if disp_id:
+        agg = agg.where(Producto.dispenser_id == disp_id)
+    max_upd, total = db.session.execute(agg).one()
+    return hashlib.blake2b(
+        f"{max_upd.isoformat() if max_upd else ''}|{total}".encode(), digest_size=8
+    ).hexdigest()
+
+def _productos_body(disp_id: int, fields: list) -> bytes:
+    if fields:
+        stmt = db.select(*(_PRODUCTO_FIELD_COLS[f] for f in fields))
+    else:
+        stmt = db.select(*_PRODUCTO_COLS)
     if disp_id:
-        q = q.filter(Producto.dispenser_id == disp_id)
+        stmt = stmt.where(Producto.dispenser_id == disp_id)
 
-    q = q.order_by(Producto.slot_id.asc()).all()
+    # Mismo orden que uq_disp_slot: con o sin filtro se lee del índice, sin sort
+    rows = db.session.execute(
+        stmt.order_by(Producto.dispenser_id.asc(), Producto.slot_id.asc())
+    ).all()
 
-    return jsonify([serialize_producto(p) for p in q])
+    if fields:
+        return _dumps([dict(zip(fields, r)) for r in rows], option=_JSON_RESPONSE_OPTS)
+    return _dumps([serialize_producto(r) for r in rows], option=_JSON_RESPONSE_OPTS)
 
-@app.post("/api/productos")
-def api_productos_create():
-    require_admin()
+@app.get("/api/productos")
+def api_productos_list():
+    disp_id = _to_int(request.args.get("dispenser_id") or 0)
 
-    data = request.get_json(silent=True) or {}
+    # ?fields=id,nombre,precio → sólo esas columnas en el SELECT y en la respuesta
+    fields = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()]
+    invalidos = [f for f in fields if f not in _PRODUCTO_FIELD_COLS]
+    if invalidos:
+        return json_error("fields inválidos", 400, invalidos)
+
+    key = (disp_id, tuple(fields))
+    now = time.monotonic()
+    entry = _PRODUCTOS_CACHE.get(key)
+
+    if entry is None or now - entry[0] >= _PRODUCTOS_CACHE_TTL:
+        etag = _productos_etag(disp_id)
+        if entry is not None and entry[1] == etag:
+            # Vencido pero sin cambios en DB: se reusa el body ya serializado
+            entry = (now, etag, entry[2])
+        else:
+            entry = (now, etag, _productos_body(disp_id, fields))
+        if len(_PRODUCTOS_CACHE) >= _PRODUCTOS_CACHE_MAX:
+            _PRODUCTOS_CACHE.clear()
+        _PRODUCTOS_CACHE[key] = entry
+
+    _, etag, body = entry
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    # Mismo horizonte que el cache del server: el navegador no repregunta
+    # durante 5s y después revalida con If-None-Match
+    resp.cache_control.private = True
+    resp.cache_control.max_age = int(_PRODUCTOS_CACHE_TTL)
+    return resp
+
+def _validar_producto_nuevo(data: dict):
+    """
+    Valida el body de alta de producto. Devuelve (valores, None) listo para
+    Producto(**valores) / insert, o (None, (mensaje, status)).
+    """
     dispenser_id = data.get("dispenser_id")
     nombre = (data.get("nombre") or "").strip()
     precio = data.get("precio")
@@ -823,32 +1353,26 @@ def api_productos_create():
     tiempo_ms = data.get("tiempo_ms")
 
     if not dispenser_id:
-        return json_error("dispenser_id requerido", 400)
+        return None, ("dispenser_id requerido", 400)
 
     if not nombre:
-        return json_error("nombre requerido", 400)
+        return None, ("nombre requerido", 400)
 
     try:
-        precio = float(precio)
+        precio = round(float(precio), 2)  # centavos: sin residuos de float
     except Exception:
-        return json_error("precio debe ser número", 400)
+        return None, ("precio debe ser número", 400)
 
     if precio <= 0:
-        return json_error("precio debe ser > 0", 400)
+        return None, ("precio debe ser > 0", 400)
 
     try:
         slot = int(slot)
     except Exception:
-        return json_error("slot debe ser número", 400)
+        return None, ("slot debe ser número", 400)
 
     if not 1 <= slot <= 2:
-        return json_error("slot inválido (1–2)", 400)
-
-    if Producto.query.filter(
-        Producto.dispenser_id == dispenser_id,
-        Producto.slot_id == slot
-    ).first():
-        return json_error("slot ya usado en este dispenser", 409)
+        return None, ("slot inválido (1–2)", 400)
 
     try:
         if tiempo_ms not in (None, "", []):
@@ -858,56 +1382,171 @@ def api_productos_create():
     except Exception:
         tiempo_final = 1000
 
-    p = Producto(
-        dispenser_id=dispenser_id,
-        nombre=nombre,
-        precio=precio,
-        cantidad=0,
-        slot_id=slot,
-        porcion_litros=1,
-        bundle_precios={},
-        habilitado=habilitado,
-        tiempo_ms=tiempo_final,
-    )
+    return {
+        "dispenser_id": _to_int(dispenser_id),
+        "nombre": nombre,
+        "precio": precio,
+        "cantidad": 0,
+        "slot_id": slot,
+        "porcion_litros": 1,
+        "bundle_precios": {},
+        "habilitado": habilitado,
+        "tiempo_ms": tiempo_final,
+    }, None
+
+def _validar_producto_cambios(data: dict):
+    """
+    Valida un update parcial de producto con las mismas reglas que el alta.
+    Devuelve (cambios, None) con nombres de columna, o (None, (mensaje, status)).
+    """
+    cambios = {}
+
+    if "nombre" in data:
+        nombre = str(data["nombre"] or "").strip()
+        if not nombre:
+            return None, ("nombre requerido", 400)
+        cambios["nombre"] = nombre
+
+    if "precio" in data:
+        try:
+            precio = round(float(data["precio"]), 2)
+        except Exception:
+            return None, ("precio debe ser número", 400)
+        if precio <= 0:
+            return None, ("precio debe ser > 0", 400)
+        cambios["precio"] = precio
+
+    if "habilitado" in data:
+        cambios["habilitado"] = bool(data["habilitado"])
 
-    db.session.add(p)
+    if "slot" in data:
+        try:
+            slot = int(data["slot"])
+        except Exception:
+            return None, ("slot debe ser número", 400)
+        if not 1 <= slot <= 2:
+            return None, ("slot inválido (1–2)", 400)
+        cambios["slot_id"] = slot
+
+    if "tiempo_ms" in data:
+        try:
+            if data["tiempo_ms"] not in ("", None):
+                cambios["tiempo_ms"] = int(data["tiempo_ms"])
+        except Exception:
+            pass
+
+    return cambios, None
+
+@app.post("/api/productos")
+def api_productos_create():
+    require_admin()
+
+    data = request.get_json(silent=True) or {}
+    valores, err = _validar_producto_nuevo(data)
+    if err:
+        return json_error(*err)
+
+    # INSERT … ON CONFLICT DO NOTHING sobre uq_disp_slot: un solo round-trip
+    # y sin carrera entre chequear el slot e insertar. Sin fila → slot ocupado.
+    row = db.session.execute(
+        pg_insert(Producto)
+        .values(**valores)
+        .on_conflict_do_nothing(constraint="uq_disp_slot")
+        .returning(*_PRODUCTO_COLS)
+    ).first()
     db.session.commit()
 
-    return ok_json({"ok": True, "producto": serialize_producto(p)}, 201)
+    if row is None:
+        return json_error("slot ya usado en este dispenser", 409)
+
+    set_tiempo_ms_cache(row)
+    _invalidar_productos_cache()
+
+    return ok_json({"ok": True, "producto": serialize_producto(row)}, 201)
+
+@app.post("/api/productos/bulk")
+def api_productos_bulk_create():
+    """
+    Alta de varios productos: body = [ {dispenser_id, nombre, precio, slot, ...}, ... ].
+    Todo o nada: un solo INSERT … RETURNING y un commit.
+    """
+    require_admin()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not data:
+        return json_error("se espera una lista de productos", 400)
+
+    filas = []
+    for i, item in enumerate(data):
+        valores, err = _validar_producto_nuevo(item if isinstance(item, dict) else {})
+        if err:
+            return json_error(err[0], err[1], {"index": i})
+        filas.append(valores)
+
+    pares = {(f["dispenser_id"], f["slot_id"]) for f in filas}
+    if len(pares) != len(filas):
+        return json_error("slot repetido en la lista", 409)
+
+    ocupado = db.session.execute(
+        db.select(Producto.dispenser_id, Producto.slot_id)
+        .where(db.tuple_(Producto.dispenser_id, Producto.slot_id).in_(pares))
+        .limit(1)
+    ).first()
+    if ocupado:
+        return json_error(
+            "slot ya usado en este dispenser", 409,
+            {"dispenser_id": ocupado.dispenser_id, "slot": ocupado.slot_id},
+        )
+
+    try:
+        rows = db.session.execute(
+            db.insert(Producto).returning(*_PRODUCTO_COLS, sort_by_parameter_order=True),
+            filas,
+        ).all()
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        # Otro request ocupó el slot entre el chequeo y el INSERT
+        if getattr(getattr(e.orig, "diag", None), "constraint_name", None) == "uq_disp_slot":
+            return json_error("slot ya usado en este dispenser", 409)
+        return json_error("error creando productos", 500, str(e))
+    except Exception as e:
+        db.session.rollback()
+        return json_error("error creando productos", 500, str(e))
+
+    for r in rows:
+        set_tiempo_ms_cache(r)
+    _invalidar_productos_cache()
+
+    return orjson_response({"ok": True, "productos": [serialize_producto(r) for r in rows]}, 201)
 
 @app.put("/api/productos/<int:pid>")
 def api_productos_update(pid):
-    p = Producto.query.get_or_404(pid)
+    p = db.get_or_404(Producto, pid)
+    slot_anterior = p.slot_id
     data = request.get_json(silent=True) or {}
+    cambios, err = _validar_producto_cambios(data)
+    if err:
+        return json_error(*err)
+
     try:
-        if "nombre" in data:
-            p.nombre = str(data["nombre"]).strip()
-        if "precio" in data:
-            precio = float(data["precio"])
-            if precio <= 0:
-                return json_error("precio debe ser > 0", 400)
-            p.precio = precio
-        if "habilitado" in data:
-            p.habilitado = bool(data["habilitado"])
-        if "slot" in data:
-            new_slot = _to_int(data["slot"])
-            if new_slot != p.slot_id:
-                if Producto.query.filter(
+        new_slot = cambios.get("slot_id")
+        if new_slot is not None and new_slot != p.slot_id:
+            if db.session.scalar(
+                db.select(Producto.id).where(
                     Producto.dispenser_id == p.dispenser_id,
                     Producto.slot_id == new_slot,
                     Producto.id != p.id,
-                ).first():
-                    return json_error("slot ya usado en este dispenser", 409)
-                p.slot_id = new_slot
+                ).limit(1)
+            ):
+                return json_error("slot ya usado en este dispenser", 409)
 
-        if "tiempo_ms" in data:
-            try:
-                if data["tiempo_ms"] not in ("", None):
-                    p.tiempo_ms = int(data["tiempo_ms"])
-            except Exception:
-                pass
+        for campo, valor in cambios.items():
+            setattr(p, campo, valor)
 
         db.session.commit()
+        set_tiempo_ms_cache(p, slot_anterior)
+        _invalidar_productos_cache()
         return ok_json({"ok": True, "producto": serialize_producto(p)})
     except Exception as e:
         db.session.rollback()
@@ -925,27 +1564,18 @@ def api_pagos_list():
     except Exception:
         limit = 50
 
-    q = Pago.query.order_by(Pago.id.desc()).limit(limit)
-    pagos = q.all()
-
-    return jsonify([
-        {
-            "id": p.id,
-            "mp_payment_id": p.mp_payment_id,
-            "estado": p.estado,
-            "producto": p.producto,
-            "product_id": p.product_id,
-            "dispenser_id": p.dispenser_id,
-            "device_id": p.device_id,
-            "slot_id": p.slot_id,
-            "litros": p.litros,
-            "monto": p.monto,
-            "dispensado": bool(p.dispensado),
-            "procesado": bool(p.procesado),
-            "created_at": p.created_at.isoformat() if p.created_at else None,
-        }
-        for p in pagos
-    ])
+    # Paginación por cursor: ?before_id=<id del último pago de la página
+    # anterior>. Recorre el índice de la PK hacia atrás, sin OFFSET.
+    before_id = request.args.get("before_id", type=int)
+
+    # Sólo las columnas que se devuelven (sin `raw`), como filas de Core
+    stmt = db.select(*_PAGO_COLS)
+    if before_id:
+        stmt = stmt.where(Pago.id < before_id)
+    # Página acotada (≤ 200 filas): se trae entera y se serializa una vez;
+    # un error de DB sale como 500 y no como JSON truncado con 200.
+    rows = db.session.execute(stmt.order_by(Pago.id.desc()).limit(limit)).all()
+    return ok_json([serialize_pago(r) for r in rows])
 # =========================
 # CONTABLE COMPLETO POR CLIENTE
 # =========================
@@ -972,7 +1602,11 @@ def contable_completo():
             filtro_hasta = datetime.strptime(hasta, "%Y-%m-%d") + timedelta(days=1)
 
         # 1) Buscar todos los dispensers de ese cliente
-        dispensers = Dispenser.query.filter_by(cliente_id=cliente_id).all()
+        dispensers = db.session.scalars(
+            db.select(Dispenser)
+            .where(Dispenser.cliente_id == cliente_id)
+            .options(*list_load_options())
+        ).all()
         if not dispensers:
             return ok_json({
                 "total_vendido_cliente": 0,
@@ -984,17 +1618,17 @@ def contable_completo():
         disp_ids = [d.id for d in dispensers]
 
         # 2) Buscar pagos aprobados de esos dispensers
-        q = Pago.query.filter(
+        q = db.select(Pago).where(
             Pago.estado == "approved",
             Pago.dispenser_id.in_(disp_ids)
         )
 
         if filtro_desde:
-            q = q.filter(Pago.created_at >= filtro_desde)
+            q = q.where(Pago.created_at >= filtro_desde)
         if filtro_hasta:
-            q = q.filter(Pago.created_at < filtro_hasta)
+            q = q.where(Pago.created_at < filtro_hasta)
 
-        pagos = q.all()
+        pagos = db.session.scalars(q.options(*list_load_options())).all()
 
         # 3) Procesar totals
         total_cliente = sum(p.monto for p in pagos)
@@ -1035,7 +1669,7 @@ def contable_completo():
         return json_error("error en contable", 500, str(e))
 @app.post("/api/pagos/<int:pid>/reenviar")
 def api_pagos_reenviar(pid):
-    p = Pago.query.get_or_404(pid)
+    p = db.get_or_404(Pago, pid)
 
     # 🔥 Solo pagos aprobados
     if p.estado != "approved":
@@ -1051,11 +1685,12 @@ def api_pagos_reenviar(pid):
 
     device = p.device_id
     if not device:
-        # recuperar desde producto
-        prod = Producto.query.get(p.product_id)
-        if prod and prod.dispenser_id:
-            d = Dispenser.query.get(prod.dispenser_id)
-            device = d.device_id if d else ""
+        # recuperar desde producto → dispenser (un solo JOIN)
+        device = db.session.execute(
+            db.select(Dispenser.device_id)
+            .join(Dispenser.productos)
+            .where(Producto.id == p.product_id)
+        ).scalar() or ""
 
     if not device:
         return json_error("no se puede determinar device_id", 400)
@@ -1068,7 +1703,9 @@ def api_pagos_reenviar(pid):
 
     # 🔥 Marcamos como procesado pero NO como dispensado
     # para permitir más reintentos si el ESP nunca responde el ACK
-    p.procesado = True
+    db.session.execute(
+        db.update(Pago).where(Pago.id == p.id).values(procesado=True)
+    )
     db.session.commit()
 
     return ok_json({"ok": True, "msg": "comando reenviado"})
@@ -1088,87 +1725,124 @@ def get_backend_base() -> str:
         base = (request.url_root or "").rstrip("/")
     return base
 
+@lru_cache(maxsize=8)
+def _mp_pref_static(backend_url: str) -> dict:
+    """
+    Partes fijas de la preferencia (sólo dependen de la URL del backend).
+    Se arman una vez por URL; no modificar el dict devuelto.
+    """
+    gracias = f"{backend_url}/gracias"
+    return {
+        "notification_url": f"{backend_url}/api/mp/webhook",
+        "auto_return": "approved",
+        "back_urls": {
+            "success": gracias,
+            "failure": gracias,
+            "pending": gracias
+        },
+        "purpose": "wallet_purchase",
+        "expires": False,
+        "binary_mode": False,
+        "statement_descriptor": "DISPEN-AGUA"
+    }
+
+def _create_mp_preference(prod, device_id: str, token: str, backend_url: str, *, monto, external_reference=None) -> dict:
+    """
+    Crea la preferencia de Checkout Pro para un producto (ORM o fila con
+    id/nombre/slot_id/dispenser_id) con el token del cliente. Usado por la
+    preferencia admin y por el QR universal.
+    Lanza excepción si MP responde con error; devuelve la preferencia.
+    """
+    body = {
+        **_mp_pref_static(backend_url),
+        "items": [{
+            "id": str(prod.id),
+            "title": prod.nombre,
+            "description": prod.nombre,
+            "quantity": 1,
+            "currency_id": "ARS",
+            "unit_price": float(monto),
+        }],
+        "metadata": {
+            "product_id": prod.id,
+            "slot_id": prod.slot_id,
+            "producto": prod.nombre,
+            "litros": 1,
+            "dispenser_id": prod.dispenser_id,
+            "device_id": device_id,
+            "precio_final": monto,
+        },
+    }
+    if external_reference:
+        body["external_reference"] = external_reference
+
+    r = _mp_session.post(
+        "https://api.mercadopago.com/checkout/preferences",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        },
+        data=_dumps(body),
+        timeout=MP_TIMEOUT
+    )
+    r.raise_for_status()
+    return r.json() or {}
+
 # =========================
 # PAGOS – PREFERENCIA (Admin) MULTI-CLIENTE
 # =========================
 
 @app.post("/api/pagos/preferencia")
 def crear_preferencia_api():
-    import time as _time
     data = request.get_json(force=True, silent=True) or {}
     product_id = _to_int(data.get("product_id") or 0)
 
-    prod = Producto.query.get(product_id)
+    # Producto + dispenser en un solo SELECT de Core, sólo las columnas que
+    # usa la preferencia (sin instancias ORM ni bundle_precios JSONB)
+    prod = db.session.execute(
+        db.select(
+            Producto.id, Producto.nombre, Producto.precio, Producto.slot_id,
+            Producto.habilitado, Producto.dispenser_id,
+            Dispenser.device_id, Dispenser.activo.label("disp_activo"),
+        )
+        .outerjoin(Dispenser, Dispenser.id == Producto.dispenser_id)
+        .where(Producto.id == product_id)
+    ).first()
     if not prod or not prod.habilitado:
         return json_error("producto no disponible", 400)
 
-    disp = Dispenser.query.get(prod.dispenser_id)
-    if not disp or not disp.activo:
+    if prod.dispenser_id is None or not prod.disp_activo:
         return json_error("dispenser no disponible", 400)
 
     # TOKEN MULTI-CLIENTE
     try:
-        token = get_token_por_dispenser(disp.id)
+        token = get_token_por_dispenser(prod.dispenser_id)
     except Exception as e:
         return json_error("mp_token_error", 500, str(e))
 
     monto_final = int(prod.precio)
-    ts = int(_time.time())
+    ts = int(time.time())
 
     external_reference = (
-        f"product_id={prod.id};slot={prod.slot_id};disp={disp.id};dev={disp.device_id};ts={ts}"
+        f"product_id={prod.id};slot={prod.slot_id};disp={prod.dispenser_id};dev={prod.device_id};ts={ts}"
     )
 
     backend_url = get_backend_base()
 
-    body = {
-        "items": [{
-            "id": str(prod.id),
-            "title": prod.nombre,
-            "description": prod.nombre,
-            "quantity": 1,
-            "currency_id": "ARS",
-            "unit_price": float(monto_final),
-        }],
-        "metadata": {
-            "product_id": prod.id,
-            "slot_id": prod.slot_id,
-            "producto": prod.nombre,
-            "litros": 1,
-            "dispenser_id": disp.id,
-            "device_id": disp.device_id,
-            "precio_final": monto_final,
-        },
-        "external_reference": external_reference,
-        "auto_return": "approved",
-        "back_urls": {
-            "success": f"{backend_url}/gracias",
-            "failure": f"{backend_url}/gracias",
-            "pending": f"{backend_url}/gracias"
-        },
-        "notification_url": f"{backend_url}/api/mp/webhook",
-        "purpose": "wallet_purchase",
-        "expires": False,
-        "binary_mode": False,
-        "statement_descriptor": "DISPEN-AGUA"
-    }
+    # Todo lo que usa la preferencia ya está leído: se devuelve la conexión
+    # al pool antes del POST a MP (no retenerla durante la llamada HTTPS)
+    db.session.close()
 
     try:
-        r = requests.post(
-            "https://api.mercadopago.com/checkout/preferences",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            },
-            json=body,
-            timeout=20
+        pref = _create_mp_preference(
+            prod, prod.device_id, token, backend_url,
+            monto=monto_final, external_reference=external_reference,
         )
-        r.raise_for_status()
     except Exception as e:
-        detail = getattr(r, "text", str(e))[:600]
+        resp = getattr(e, "response", None)
+        detail = (resp.text if resp is not None else str(e))[:600]
         return json_error("mp_preference_failed", 502, detail)
 
-    pref = r.json() or {}
     link = pref.get("init_point") or pref.get("sandbox_init_point")
     if not link:
         return json_error("preferencia_sin_link", 502, pref)
@@ -1179,6 +1853,21 @@ def crear_preferencia_api():
 # QR UNIVERSAL MULTI-CLIENTE
 # =========================
 
+# La preferencia del QR no lleva external_reference ni timestamp: para el
+# mismo producto/precio/token es idéntica y MP acepta varios pagos sobre
+# ella. Se reusa el link en vez de crear una preferencia por escaneo. La
+# clave incluye todo lo que entra en el body, así un cambio de precio,
+# nombre o token genera una nueva.
+_QR_LINK_TTL = 3600.0
+_QR_LINK_MAX = 1024
+_QR_LINK_CACHE: dict[tuple, tuple[float, str]] = {}
+
+def _qr_link_key(disp, prod, token: str, backend_url: str) -> tuple:
+    return (
+        disp.id, disp.device_id, prod.id, prod.slot_id, prod.nombre,
+        int(round(float(prod.precio) * 100)), token, backend_url,
+    )
+
 @app.get("/qr/<device_id>/<int:slot_id>")
 def qr_universal(device_id, slot_id):
     """
@@ -1186,17 +1875,17 @@ def qr_universal(device_id, slot_id):
     Cada dispenser usa el token del cliente dueño.
     """
 
-    # 1) Dispenser
-    disp = Dispenser.query.filter_by(device_id=device_id).first()
+    # 1) Dispenser + 2) Producto del slot, en un solo SELECT (LEFT JOIN)
+    row = db.session.execute(
+        db.select(Dispenser, Producto)
+        .outerjoin(Dispenser.productos.and_(Producto.slot_id == slot_id))
+        .where(Dispenser.device_id == device_id)
+    ).first()
+    disp, prod = row if row else (None, None)
+
     if not disp or not disp.activo:
         return "Dispenser no disponible", 404
 
-    # 2) Producto
-    prod = Producto.query.filter_by(
-        dispenser_id=disp.id,
-        slot_id=slot_id
-    ).first()
-
     if not prod or not prod.habilitado:
         return "Producto no disponible", 404
 
@@ -1207,64 +1896,163 @@ def qr_universal(device_id, slot_id):
         return f"MP token no configurado: {e}", 500
 
     backend_url = get_backend_base()
-    monto_final = float(prod.precio)
 
-    body = {
-        "items": [{
-            "id": str(prod.id),
-            "title": prod.nombre,
-            "description": prod.nombre,
-            "quantity": 1,
-            "currency_id": "ARS",
-            "unit_price": monto_final,
-        }],
-        "metadata": {
-            "product_id": prod.id,
-            "slot_id": prod.slot_id,
-            "producto": prod.nombre,
-            "litros": 1,
-            "dispenser_id": disp.id,
-            "device_id": disp.device_id,
-            "precio_final": monto_final,
-        },
-        "notification_url": f"{backend_url}/api/mp/webhook",
-        "auto_return": "approved",
-        "back_urls": {
-            "success": f"{backend_url}/gracias",
-            "failure": f"{backend_url}/gracias",
-            "pending": f"{backend_url}/gracias"
-        },
-        "purpose": "wallet_purchase",
-        "expires": False,
-        "binary_mode": False,
-        "statement_descriptor": "DISPEN-AGUA"
-    }
+    key = _qr_link_key(disp, prod, token, backend_url)
+    now = time.monotonic()
+    hit = _QR_LINK_CACHE.get(key)
+    if hit and now - hit[0] < _QR_LINK_TTL:
+        return redirect(hit[1])
+
+    # Conexión de vuelta al pool antes de la llamada a MP
+    db.session.close()
 
     try:
-        r = requests.post(
-            "https://api.mercadopago.com/checkout/preferences",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            },
-            json=body,
-            timeout=20
-        )
-        r.raise_for_status()
+        pref = _create_mp_preference(prod, disp.device_id, token, backend_url, monto=float(prod.precio))
     except Exception as e:
         return f"Error al crear preferencia: {e}", 500
 
-    pref = r.json() or {}
     link = pref.get("init_point") or pref.get("sandbox_init_point")
     if not link:
         return "Preferencia sin link", 502
 
+    if len(_QR_LINK_CACHE) >= _QR_LINK_MAX:
+        _QR_LINK_CACHE.clear()
+    _QR_LINK_CACHE[key] = (now, link)
+
     return redirect(link)
 
 # =========================
 # WEBHOOK MP (payment + merchant_order)
 # =========================
 
+# MP reintenta si el webhook tarda en responder: devolvemos "ok" enseguida
+# y las consultas a MP + DB + MQTT corren en un pool de hilos propio.
+WEBHOOK_WORKERS = 4
+_webhook_executor = ThreadPoolExecutor(
+    max_workers=WEBHOOK_WORKERS, thread_name_prefix="mp-webhook"
+)
+
+# GETs de pagos de una merchant_order en paralelo (sólo HTTP, sin DB)
+MO_FETCH_WORKERS = 8
+_mo_fetch_executor = ThreadPoolExecutor(
+    max_workers=MO_FETCH_WORKERS, thread_name_prefix="mp-mo-fetch"
+)
+
+# MP reenvía la misma notificación (mismo `id` de notificación) hasta
+# recibir 200 y a veces en ráfaga: los reintentos dentro de la ventana se
+# descartan antes de consultar a MP. No se deduplica sólo por payment_id:
+# un cambio pending → approved llega como notificación nueva del mismo pago.
+# Es un filtro por proceso y best-effort (otro worker no lo ve): lo que evita
+# dispensar dos veces es el reclamo atómico en _procesar_pago_desde_info.
+_WEBHOOK_SEEN_TTL = 3600.0
+_WEBHOOK_SEEN_MAX = 10000
+_WEBHOOK_SEEN: dict[tuple, float] = {}
+_webhook_seen_lock = threading.Lock()
+
+def _notificacion_ref_id(data: dict) -> Optional[str]:
+    """
+    Id del recurso notificado (payment o merchant_order): `data.id` en
+    webhooks, último segmento de `resource` en IPN.
+    """
+    ref_id = None
+    if isinstance(data.get("data"), dict):
+        ref_id = data["data"].get("id")
+    if not ref_id and data.get("resource"):
+        ref_id = str(data["resource"]).split("/")[-1]
+    return str(ref_id) if ref_id else None
+
+def _webhook_ya_visto(tipo: str, notif_id, ref_id: str) -> bool:
+    if not notif_id:
+        return False
+
+    key = (tipo, str(notif_id), ref_id)
+
+    now = time.monotonic()
+    with _webhook_seen_lock:
+        visto = _WEBHOOK_SEEN.get(key)
+        if visto and now - visto < _WEBHOOK_SEEN_TTL:
+            return True
+        if len(_WEBHOOK_SEEN) >= _WEBHOOK_SEEN_MAX:
+            _WEBHOOK_SEEN.clear()
+        _WEBHOOK_SEEN[key] = now
+    return False
+
+class _MPSessionHttpClient(MPHttpClient):
+    """
+    HttpClient del SDK de MP sobre _mp_session: el cliente por defecto abre
+    una requests.Session (y un handshake TLS) nueva por cada llamada.
+    Los reintentos los hace el Retry montado en la sesión.
+    """
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        # El SDK no pone timeout: sin esto un MP colgado bloquea el worker
+        kwargs["timeout"] = MP_TIMEOUT
+        r = _mp_session.request(method, url, **kwargs)
+        return {"status": r.status_code, "response": _loads(r.content) if r.content else None}
+
+_mp_http_client = _MPSessionHttpClient()
+
+@lru_cache(maxsize=128)
+def _sdk_for(token: str):
+    # Una instancia de SDK por token (se reusa entre notificaciones)
+    return mercadopago.SDK(token, http_client=_mp_http_client)
+
+def _process_mp_notification(tipo: str, ref_id: str):
+    with app.app_context():
+        try:
+            _process_mp_notification_ctx(tipo, ref_id)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"[WEBHOOK ERROR] {e}")
+
+def _process_mp_notification_ctx(tipo: str, ref_id: str):
+    # Siempre usamos token GLOBAL solo para consultar info.
+    token_global, _ = get_global_mp_token_and_base()
+    mp_sdk = _sdk_for(token_global)
+    # La lectura de mp_mode pudo abrir transacción: liberarla antes de los
+    # GET a MP; _procesar_pago_desde_info toma conexión recién para el upsert
+    db.session.close()
+
+    # ---- PAYMENT ----
+    if "payment" in tipo:
+        payment_id = ref_id
+
+        try:
+            resp = mp_sdk.payment().get(str(payment_id))
+            info = resp.get("response") or {}
+            _procesar_pago_desde_info(str(payment_id), info)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"[WEBHOOK] Error procesando pago {payment_id}: {e}")
+            return
+
+    # ---- MERCHANT ORDER ----
+    if "merchant_order" in tipo:
+        mo_id = ref_id
+
+        try:
+            mo_resp = mp_sdk.merchant_order().get(str(mo_id))
+            mo_info = mo_resp.get("response") or {}
+        except Exception:
+            return
+
+        ids = [str(pay["id"]) for pay in (mo_info.get("payments") or []) if pay.get("id")]
+        futs = [_mo_fetch_executor.submit(mp_sdk.payment().get, p_id) for p_id in ids]
+
+        # La consulta a MP es concurrente; el procesamiento (DB + MQTT)
+        # sigue siendo secuencial y en el orden de la orden
+        # Cada pago es su propia transacción: si uno falla se hace rollback
+        # y los siguientes no heredan una sesión abortada
+        for p_id, fut in zip(ids, futs):
+            try:
+                resp = fut.result()
+                info = resp.get("response") or {}
+                _procesar_pago_desde_info(p_id, info)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"[WEBHOOK] Error procesando pago {p_id}: {e}")
+                continue
+
 @app.post("/api/mp/webhook")
 def mp_webhook():
     try:
@@ -1280,60 +2068,16 @@ def mp_webhook():
         if not ("payment" in tipo or "merchant_order" in tipo):
             return "ok", 200
 
-        # Siempre usamos token GLOBAL solo para consultar info.
-        token_global, _ = get_global_mp_token_and_base()
-        mp_sdk = mercadopago.SDK(token_global)
-
-        # ---- PAYMENT ----
-        if "payment" in tipo:
-            payment_id = None
-
-            if isinstance(data.get("data"), dict):
-                payment_id = data["data"].get("id")
-
-            if not payment_id and data.get("resource"):
-                payment_id = str(data["resource"]).split("/")[-1]
-
-            if not payment_id:
-                return "ok", 200
-
-            try:
-                resp = mp_sdk.payment().get(str(payment_id))
-                info = resp.get("response") or {}
-                _procesar_pago_desde_info(str(payment_id), info)
-            except Exception:
-                return "ok", 200
-
-        # ---- MERCHANT ORDER ----
-        if "merchant_order" in tipo:
-            mo_id = None
-
-            if isinstance(data.get("data"), dict):
-                mo_id = data["data"].get("id")
-
-            if not mo_id and data.get("resource"):
-                mo_id = str(data["resource"]).split("/")[-1]
-
-            if not mo_id:
-                return "ok", 200
+        # Sin id de recurso (pings / pruebas) no hay nada que consultar
+        ref_id = _notificacion_ref_id(data)
+        if not ref_id:
+            return "ok", 200
 
-            try:
-                mo_resp = mp_sdk.merchant_order().get(str(mo_id))
-                mo_info = mo_resp.get("response") or {}
-            except Exception:
-                return "ok", 200
-
-            for pay in mo_info.get("payments") or []:
-                p_id = pay.get("id")
-                if not p_id:
-                    continue
-                try:
-                    resp = mp_sdk.payment().get(str(p_id))
-                    info = resp.get("response") or {}
-                    _procesar_pago_desde_info(str(p_id), info)
-                except Exception:
-                    continue
+        if _webhook_ya_visto(tipo, data.get("id"), ref_id):
+            app.logger.info(f"[WEBHOOK] duplicado ignorado: {data.get('id')}")
+            return "ok", 200
 
+        _webhook_executor.submit(_process_mp_notification, tipo, ref_id)
         return "ok", 200
 
     except Exception as e:
@@ -1399,7 +2143,7 @@ def mp_oauth_callback():
     redirect_uri = f"{base}/api/mp/oauth/callback"
 
     try:
-        r = requests.post(
+        r = _mp_session.post(
             "https://api.mercadopago.com/oauth/token",
             json={
                 "client_id": MP_CLIENT_ID,
@@ -1408,7 +2152,7 @@ def mp_oauth_callback():
                 "code": code,
                 "redirect_uri": redirect_uri,
             },
-            timeout=20,
+            timeout=MP_TIMEOUT,
         )
         r.raise_for_status()
     except Exception as e:
@@ -1424,7 +2168,9 @@ def mp_oauth_callback():
         return json_error("No se recibió access_token", 500)
 
     # Guardar token multi-cliente
-    tok = MpTokenPorCliente.query.filter_by(cliente_id=cliente_id).first()
+    tok = db.session.scalars(
+        db.select(MpTokenPorCliente).where(MpTokenPorCliente.cliente_id == cliente_id)
+    ).first()
     if not tok:
         tok = MpTokenPorCliente(cliente_id=cliente_id)
 
@@ -1435,6 +2181,7 @@ def mp_oauth_callback():
 
     db.session.add(tok)
     db.session.commit()
+    invalidar_token_cache()
 
     # HTML de confirmación
     html = """
@@ -1462,7 +2209,9 @@ def mp_oauth_status():
     if not cliente_id:
         return json_error("cliente_id requerido", 400)
 
-    tok = MpTokenPorCliente.query.filter_by(cliente_id=cliente_id).first()
+    tok = db.session.scalars(
+        db.select(MpTokenPorCliente).where(MpTokenPorCliente.cliente_id == cliente_id)
+    ).first()
     if not tok:
         return ok_json({"vinculado": False})
 
@@ -1478,10 +2227,14 @@ def mp_oauth_unlink():
     if not cliente_id:
         return json_error("cliente_id requerido", 400)
 
-    tok = MpTokenPorCliente.query.filter_by(cliente_id=cliente_id).first()
-    if tok:
-        db.session.delete(tok)
-        db.session.commit()
+    borrado = db.session.execute(
+        db.delete(MpTokenPorCliente)
+        .where(MpTokenPorCliente.cliente_id == cliente_id)
+        .returning(MpTokenPorCliente.id)
+    ).first()
+    db.session.commit()
+    if borrado is not None:
+        invalidar_token_cache()
 
     return ok_json({"ok": True, "msg": "Desvinculado"})
 
@@ -1556,6 +2309,19 @@ def pagina_gracias():
     r = make_response(html, 200)
     r.headers["Content-type"] = "text/html; charset=utf-8"
     return r
+# =========================
+# POLÍTICA DE AUTH POR ENDPOINT
+# =========================
+
+# Se resuelve una sola vez, con todas las rutas ya registradas. En cada
+# request Flask ya hizo el matching de la URL, así que _auth_guard sólo
+# necesita un lookup por endpoint (cubre también /qr/<device>/<slot>).
+_PUBLIC_ENDPOINTS = frozenset(
+    rule.endpoint
+    for rule in app.url_map.iter_rules()
+    if rule.rule in PUBLIC_PATHS or rule.rule.startswith(PUBLIC_PREFIXES)
+)
+
 # =========================
 # INIT MQTT
 # =========================
@@ -1569,38 +2335,54 @@ with app.app_context():
 #------------------------------ #      
 
 def watchdog_offline():
+    # Intervalo fijo sobre reloj monotónico: la duración del UPDATE no
+    # desplaza los ticks siguientes
+    proximo = time.monotonic()
     while True:
         try:
             with app.app_context():   # ← ESTA ES LA CLAVE
-                limite = datetime.utcnow() - timedelta(seconds=12)
-                disps = Dispenser.query.all()
-
-                for d in disps:
-                    if d.last_seen and d.last_seen < limite and d.online:
-                        d.online = False
-
+                # Reloj de la DB: last_seen se escribe con now() (timestamptz),
+                # comparar contra un utcnow() naive depende del TZ de la sesión
+                limite = db.func.now() - timedelta(seconds=12)
+                db.session.execute(
+                    db.update(Dispenser)
+                    .where(Dispenser.last_seen < limite, Dispenser.online.is_(True))
+                    .values(online=False),
+                    execution_options={"synchronize_session": False},
+                )
                 db.session.commit()
 
-        except Exception as e:
-            print("Error en watchdog:", e)
-
-        time.sleep(5)
+        except Exception:
+            app.logger.exception("[WATCHDOG] error marcando dispensers offline")
 
+        proximo += WATCHDOG_INTERVAL_S
+        espera = proximo - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        else:
+            # Atrasados (DB lenta): re-sincronizar en vez de encadenar ticks
+            proximo = time.monotonic()
 
-threading.Thread(target=watchdog_offline, daemon=True).start()
 
 # =========================
 # INICIAR WATCHDOG (OFFLINE DETECTOR)
 # =========================
 
 def start_watchdog():
+    if not RUN_SCHEDULER:
+        app.logger.info("[WATCHDOG] deshabilitado en este proceso (RUN_SCHEDULER=0)")
+        return
+    # Un solo hilo por proceso aunque el módulo se re-ejecute / se llame dos veces
+    if getattr(app, "_watchdog_started", False):
+        return
+    app._watchdog_started = True
     try:
         with app.app_context():
         # hilo que marca offline cuando no hay last_seen por 45 segundos
             threading.Thread(target=watchdog_offline, daemon=True).start()
-            print("[WATCHDOG] iniciado correctamente")
-    except Exception as e:
-        print("[WATCHDOG] error iniciando:", e)
+            app.logger.info("[WATCHDOG] iniciado correctamente")
+    except Exception:
+        app.logger.exception("[WATCHDOG] error iniciando")
 
 start_watchdog()
 # =========================
@@ -1,14 +0,0 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import os
-
-# Leemos la URL de la base de datos desde las variables de entorno
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-# Creamos el engine de SQLAlchemy
-engine = create_engine(DATABASE_URL)
-
-# Creamos el Session y la base
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file